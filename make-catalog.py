@@ -1,17 +1,32 @@
 import argparse
-from collections import namedtuple
+from collections import deque, namedtuple
+from concurrent.futures import Future, ThreadPoolExecutor
+import copy
 from functools import cached_property
-from io import StringIO
+import hashlib
 import itertools
 import logging
 import os
 import re
-import semver
 import shutil
 import subprocess
 import sys
+import threading
+from types import SimpleNamespace
+from typing import NamedTuple
 import yaml
 
+try:
+    from yaml import CSafeLoader, CSafeDumper
+except ImportError:
+    from yaml import SafeLoader as CSafeLoader, SafeDumper as CSafeDumper
+
+
+_TOP_LEVEL_KEY_RE = re.compile(r'^[a-zA-Z]', re.MULTILINE)
+_VERSION_RE = re.compile(r'(v?)([0-9.]*)$')
+_NONWS_RE = re.compile(r'\S')
+_SCHEMA_RE = re.compile(r'^schema:[ \t]*(\S+)', re.MULTILINE)
+
 
 class CataloggerCommandLineArgs:
     debug = False
@@ -40,22 +55,23 @@ class Catalogger:
         self.logger.setLevel(logging.DEBUG if self.args.debug else logging.INFO)
 
     def render (self):
-        with open(os.path.join(self.configs_out, "index.yaml"), "w") as configs_out_fd:
+        with open(os.path.join(self.configs_out, "index.yaml"), "w",
+                  buffering=1<<20) as configs_out_fd:
             def print_yaml (yaml_string):
-                configs_out_fd.write(yaml_string)
-                configs_out_fd.write("\n---\n")
+                configs_out_fd.write(yaml_string + "\n---\n")
 
             for input_filename in self.args.inputs:
                 package = OlmPackageParser(self.logger, input_filename)
                 print_yaml(package.olm_package_yaml)
                 for channel in package.channels:
-                    print_yaml(channel.olm_channel_yaml)
+                    channel.write_olm_channel_yaml(configs_out_fd)
+                    configs_out_fd.write("\n---\n")
 
             for bundle_version in BundleVersion.all_loaded():
                 for y in bundle_version.yamls:
                     print_yaml(y)
 
-    @property
+    @cached_property
     def has_opm (self):
         return shutil.which("opm") is not None
 
@@ -67,41 +83,65 @@ class Catalogger:
                               self.configs_out,
                               f"--cache-dir={self.args.cache_out}"])
 
-    @property
+    @cached_property
     def configs_out (self):
         configs_out = self.args.configs_out
         self._ensure_dir(configs_out)
         return configs_out
 
 
-    @property
+    @cached_property
     def cache_out (self):
         cache_out = self.args.cache_out
         self._ensure_dir(cache_out)
         return cache_out
 
     def _ensure_dir (self, dir):
-        try:
-            os.makedirs(dir)
-        except FileExistsError:
-            pass
+        os.makedirs(dir, exist_ok=True)
 
 
-def run_opm (cmdline_args, *args, **kwargs):
-    if "check" not in kwargs:
-        kwargs["check"] = True
+def run_opm (cmdline_args, *args, stream=False, **kwargs):
+    """Run `opm` with `cmdline_args`.
 
+    If `stream` is true, return a `subprocess.Popen` object whose
+    `stdout` can be iterated upon line by line, as `opm` produces it;
+    the caller is responsible for waiting on it and checking its
+    `returncode`. Otherwise, wait for `opm` to complete and return a
+    `subprocess.CompletedProcess` (with `check=True` by default).
+    """
     cmdline = ["opm"] + cmdline_args
 
     if "logger" in kwargs:
         logger = kwargs.pop("logger")
         logger.info("Running " + " ".join(cmdline))
 
+    if stream:
+        return subprocess.Popen(cmdline, *args, encoding="utf-8",
+                                stdout=subprocess.PIPE, **kwargs)
+
+    if "check" not in kwargs:
+        kwargs["check"] = True
+
     return subprocess.run(cmdline, *args, text=True, **kwargs)
 
+
+_LOG_COLORS = {
+    logging.DEBUG: "\x1b[38;20m",       # grey
+    logging.INFO: "\x1b[38;20m",        # grey
+    logging.WARNING: "\x1b[33;20m",     # yellow
+    logging.ERROR: "\x1b[31;20m",       # red
+    logging.CRITICAL: "\x1b[31;1m"      # bold red
+}
+
+
 class CataloggerLogger:
     def __init__ (self):
         self.prefixes = []
+        self._log_prefix = ""
+        self._formatters = {
+            level: logging.Formatter(f"{ color }%(levelname)s:\x1b[0m %(message)s")
+            for level, color in _LOG_COLORS.items()
+        }
         self.logger = logging.getLogger(__name__)
         self.logger.propagate = False
 
@@ -115,9 +155,11 @@ class CataloggerLogger:
         class TempPrefixContext:
             def __enter__ (self):
                 this.prefixes.append(prefix)
+                this._log_prefix += f"{prefix}: "
 
             def __exit__ (self, exn_type, exn_value, exn_traceback):
                 this.prefixes.pop()
+                this._log_prefix = "".join(f"{p}: " for p in this.prefixes)
 
         return TempPrefixContext()
 
@@ -141,27 +183,10 @@ class CataloggerLogger:
         """Delegated to `self.logger`."""
         self.logger.fatal(msg, *args, **kwargs)
 
-    @property
-    def _log_prefix (self):
-        return "". join(f"{p}: " for p in self.prefixes)
-
     def format(self, record):
-        grey = "\x1b[38;20m"
-        yellow = "\x1b[33;20m"
-        red = "\x1b[31;20m"
-        bold_red = "\x1b[31;1m"
-        reset = "\x1b[0m"
-        COLORS = {
-            logging.DEBUG: grey,
-            logging.INFO: grey,
-            logging.WARNING: yellow,
-            logging.ERROR: red,
-            logging.CRITICAL: bold_red
-        }
-        log_fmt = f"{ COLORS.get(record.levelno) }%(levelname)s:{ reset } %(message)s"
-        formatter = logging.Formatter(log_fmt)
-
+        record = copy.copy(record)    # Other handlers may see the same record
         record.msg = f"{ self._log_prefix }{ record.msg }"
+        formatter = self._formatters.get(record.levelno, self._formatters[logging.INFO])
         return formatter.format(record)
 
 
@@ -170,22 +195,23 @@ class OlmPackageParser:
         self.logger = logger
         self.yaml_filename = yaml_filename
 
+        self._by_schema = {}
         with open(self.yaml_filename) as yaml_fd:
             with self.logger.temp_prefix(self.yaml_filename):
-                self._yaml_docs = list(split_yaml_documents(yaml_fd))
+                for lineno, yaml_doc in split_yaml_documents(yaml_fd):
+                    self._by_schema.setdefault(_extract_schema(yaml_doc), []).append(
+                        (lineno, yaml_doc))
 
     @property
     def olm_package_yaml (self):
-        for _, yaml_doc in self._yaml_docs:
-            if 'schema: olm.package' in yaml_doc:
-                return yaml_doc
+        for _, yaml_doc in self._by_schema.get('olm.package', []):
+            return yaml_doc
 
     @property
     def channels (self):
-        for lineno, yaml_doc in self._yaml_docs:
-            if 'schema: olm.channel' in yaml_doc:
-                with self.logger.temp_prefix(f'{self.yaml_filename}: YAML document starting at line {lineno}'):
-                    yield OlmChannelParser(self.logger, yaml_doc)
+        for lineno, yaml_doc in self._by_schema.get('olm.channel', []):
+            with self.logger.temp_prefix(f'{self.yaml_filename}: YAML document starting at line {lineno}'):
+                yield OlmChannelParser(self.logger, yaml_doc)
 
 
 class OlmChannelParser:
@@ -196,31 +222,43 @@ class OlmChannelParser:
 
     @cached_property
     def _parsed (self):
-        return re.match(
-            "(.*)^_versions:(.*?)(^[a-zA-Z].*)?\\Z", self._yaml_unexpanded,
-            re.MULTILINE|re.DOTALL)
+        """Splits the channel YAML into its prologue, `_versions:` section and epilogue."""
+        yaml_string = self._yaml_unexpanded
+        if yaml_string.startswith("_versions:"):
+            prologue, rest = "", yaml_string[len("_versions:"):]
+        else:
+            prologue, found, rest = yaml_string.partition("\n_versions:")
+            if not found:
+                return None
+            prologue = prologue + "\n"
+
+        # The `_versions:` section ends at the next top-level key, if any
+        epilogue_match = _TOP_LEVEL_KEY_RE.search(rest, 1)
+        split_at = epilogue_match.start() if epilogue_match else len(rest)
+        return SimpleNamespace(prologue=prologue,
+                               versions=rest[:split_at],
+                               epilogue=rest[split_at:])
 
     @property
     def yaml_prologue_string (self):
-        return (self._parsed[1] if self._parsed is not None else "")
+        return (self._parsed.prologue if self._parsed is not None else "")
 
     @property
     def image_versions (self):
-        return (yaml.safe_load(self._parsed[2])
-                if self._parsed is not None and self._parsed[2] is not None
+        return (yaml.load(self._parsed.versions, Loader=CSafeLoader)
+                if self._parsed is not None
                 else None)
 
     @property
     def yaml_epilogue_string (self):
-        return (self._parsed[3]
-                if self._parsed is not None and self._parsed[3] is not None
-                else "")
+        return (self._parsed.epilogue if self._parsed is not None else "")
 
     def _load_entries (self):
         versions = self.image_versions
         if not versions:
             self.logger.warning("Found channel without an expansion section")
-            self.olm_channel_yaml = self._yaml_unexpanded
+            self.entries = None
+            return
 
         entries = []
         for version in versions:
@@ -228,8 +266,7 @@ class OlmChannelParser:
             for b in BundleVersion.enumerate(
                     logger=self.logger,
                     versions_info=version):
-                for y in b.yamls:
-                    y = yaml.safe_load(y)
+                for _, y in b.yamls_with_parsed:
                     if y["schema"] == "olm.bundle":
                         entries.append(dict(
                             name=y["name"]
@@ -237,90 +274,144 @@ class OlmChannelParser:
                     if len(entries) > 1:
                         entries[-1]["replaces"] = entries[-2]["name"]
 
-        self.olm_channel_yaml = f"""
+        self.entries = entries
+
+    def write_olm_channel_yaml (self, fd):
+        """Write the `olm.channel` YAML document, with its `entries` expanded, to `fd`."""
+        if self.entries is None:
+            fd.write(self._yaml_unexpanded)
+            return
+
+        fd.write(f"""
 { self.yaml_prologue_string }
 entries:
-{ yaml.safe_dump(entries) }
+""")
+        yaml.dump(self.entries, stream=fd, Dumper=CSafeDumper)
+        fd.write(f"""
 { self.yaml_epilogue_string }
-"""
+""")
 
 
-class ImageVersion:
-    def __init__ (self, prefix, ver):
-        self.prefix = prefix
-        self.ver = (ver if isinstance(ver, semver.Version)
-                    else semver.parse_version_info(ver))
+class ImageVersion(NamedTuple):
+    prefix: str
+    major: int
+    minor: int
+    patch: int
 
     @classmethod
     def parse  (cls, version_string):
-        matched = re.match('(v?)([0-9.]*)$', version_string)
-        if not matched:
-            raise ValueError("Unable to parse f{version_string}")
+        matched = _VERSION_RE.match(version_string)
+        parts = matched[2].split(".") if matched else []
+        if len(parts) != 3 or not all(parts):
+            raise ValueError(f"Unable to parse {version_string}")
 
-        return cls(prefix=matched[1], ver=matched[2])
+        return cls(matched[1], *(int(p) for p in parts))
 
-    def inc_patchlevel (self):
-        that = self.__class__(prefix=self.prefix,
-                              ver=self.ver.replace(patch=self.ver.patch + 1))
-        return that
+    @property
+    def ver (self):
+        """The version without its prefix, e.g. `1.2.3`."""
+        return f"{self.major}.{self.minor}.{self.patch}"
 
-    def __repr__ (self):
+    def __str__ (self):
         return f"{self.prefix}{self.ver}"
 
-    def __eq__ (self, other):
-        return (self.prefix == other.prefix) and self.ver.__eq__(other.ver)
+    __repr__ = __str__
 
+    # Ordering disregards `prefix`, unlike the tuple comparisons
+    # (equality still takes it into account)
     def __gt__ (self, other):
-        return self.ver.__gt__(other.ver)
+        return self[1:] > other[1:]
 
     def __ge__ (self, other):
-        return self.ver.__ge__(other.ver)
+        return self[1:] >= other[1:]
 
     def __lt__ (self, other):
-        return self.ver.__lt__(other.ver)
+        return self[1:] < other[1:]
 
     def __le__ (self, other):
-        return self.ver.__le__(other.ver)
+        return self[1:] <= other[1:]
 
 
 class BundleVersion:
-    def __init__ (self, version, yamls):
+    def __init__ (self, version, yamls, parsed_yamls):
         self.version = version
         self.yamls = yamls
+        self.parsed_yamls = parsed_yamls
 
+    @property
+    def yamls_with_parsed (self):
+        """Yields pairs of (YAML text, parsed YAML) for each document in this bundle."""
+        return zip(self.yamls, self.parsed_yamls)
+
+    # Docker image name → BundleVersion (or None). Only ever accessed from the
+    # main thread; see `enumerate`
     _load_cache = {}
+    # SHA-256 digest of the rendered YAML → BundleVersion. Populated from
+    # worker threads, under `_content_cache_lock`
+    _content_cache = {}
+    _content_cache_lock = threading.Lock()
 
     @classmethod
-    def load (cls, logger, docker_image_name, expected_version):
-        if docker_image_name not in cls._load_cache:
-            cls._load_cache[docker_image_name] = cls._do_load(
-                logger, docker_image_name, expected_version)
-        return cls._load_cache[docker_image_name]
+    def load (cls, executor, logger, docker_image_name, expected_version):
+        """Start loading `docker_image_name` on `executor`, unless it is already cached.
+
+        :rtype: Future[:class:`BundleVersion`]; the result is None if the image could not be loaded.
+        The caller is responsible for storing the result into `_load_cache`.
+        """
+        if docker_image_name in cls._load_cache:
+            future = Future()
+            future.set_result(cls._load_cache[docker_image_name])
+            return future
+        return executor.submit(cls._do_load, logger, docker_image_name, expected_version)
 
     @classmethod
     def all_loaded (cls):
         return (bv for bv in cls._load_cache.values() if bv is not None)
 
+    @classmethod
+    def _content_cached (cls, yamls, expected_version):
+        """Returns the digest of `yamls`, and the previously loaded :class:`BundleVersion`
+        with that same content and version (or None)."""
+        # Keep document boundaries in the digest
+        digest = hashlib.sha256("\n---\n".join(yamls).encode("utf-8")).digest()
+        with cls._content_cache_lock:
+            cached = cls._content_cache.get(digest)
+        if cached is not None and cached.version != expected_version:
+            cached = None
+        return digest, cached
+
+    @classmethod
+    def _new_by_content (cls, digest, expected_version, yamls, parsed_yamls):
+        bundle_version = cls(version=expected_version,
+                             yamls=yamls,
+                             parsed_yamls=parsed_yamls)
+        with cls._content_cache_lock:
+            cls._content_cache[digest] = bundle_version
+        return bundle_version
+
     @classmethod
     def _do_load (cls, logger, docker_image_name, expected_version):
-        try:
-            opm_rendered = run_opm(
-                ["render", docker_image_name, "--output=yaml"],
-                logger=logger, stdout=subprocess.PIPE)
-        except subprocess.CalledProcessError:
+        with run_opm(["render", docker_image_name, "--output=yaml"],
+                     logger=logger, stream=True) as opm_render:
+            yamls = list(r[1] for r in split_yaml_documents(opm_render.stdout))
+        if opm_render.returncode != 0:
             return None
 
-        yamls = list(r[1] for r in split_yaml_documents(opm_rendered.stdout))
-        for y in yamls:
-            for prop in yaml.safe_load(y)["properties"]:
-                if prop["type"] == "olm.package":
-                    actual_version = prop["value"]["version"]
-                    if actual_version != expected_version.ver:
-                        logger.warning(f"Skipping malformed image f{docker_image_name} (contains version {actual_version}, expected {expected_version.ver})")
-                        return None
-                    else:
-                        return cls(version=expected_version,
-                                   yamls=yamls)
+        digest, cached = cls._content_cached(yamls, expected_version)
+        if cached is not None:
+            return cached
+
+        parsed_yamls = [yaml.load(y, Loader=CSafeLoader) for y in yamls]
+        for y in parsed_yamls:
+            actual_version = _package_version(y)
+            if actual_version is None:
+                continue
+            elif actual_version != expected_version.ver:
+                logger.warning(f"Skipping malformed image f{docker_image_name} (contains version {actual_version}, expected {expected_version.ver})")
+                return None
+            else:
+                return cls._new_by_content(digest, expected_version,
+                                           yamls, parsed_yamls)
 
         failure = f"No `olm.package` property found in {docker_image_name}!"
         logger.warning(failure)
@@ -354,22 +445,51 @@ class BundleVersion:
 
         to_skip = set(versions_info.get("skip", []))
 
-        current_version = first_version
+        def candidates ():
+            """Yields (patchlevel, version string, Docker image name) tuples."""
+            prefix = first_version.prefix
+            major, minor, patch = first_version.major, first_version.minor, first_version.patch
+            last = (None if last_version is None
+                    else (last_version.major, last_version.minor, last_version.patch))
+            while last is None or (major, minor, patch) <= last:
+                current_version_string = f"{prefix}{major}.{minor}.{patch}"
+                if current_version_string not in to_skip:
+                    yield (patch, current_version_string,
+                           pattern.replace('@@VERSION@@', current_version_string))
+                patch = patch + 1
+
+        pending = candidates()
+        in_flight = deque()
         successes = 0
-        while failures >= 0 and (last_version is None or current_version <= last_version):
-            if str(current_version) not in to_skip:
-                docker_image_name = re.sub('@@VERSION@@', str(current_version),
-                                           pattern)
-                bundle_version = cls.load(logger, docker_image_name, current_version)
-                if bundle_version is None:
-                    failures = failures - 1
-                    bailing_out_maybe = ", bailing out" if failures < 0 else ""
-                    logger.info(f"Could not load version {current_version}{bailing_out_maybe}")
-                else:
-                    successes = successes + 1
-                    yield bundle_version
-
-            current_version = current_version.inc_patchlevel()
+        with ThreadPoolExecutor(max_workers=max(failures, 0) + 1) as executor:
+            try:
+                while failures >= 0:
+                    # Running out of failure budget takes at least `failures + 1`
+                    # more attempts, so that many can be rendered ahead of time:
+                    for patch, current_version, docker_image_name in itertools.islice(
+                            pending, failures + 1 - len(in_flight)):
+                        expected_version = first_version._replace(patch=patch)
+                        in_flight.append((current_version, docker_image_name,
+                                          cls.load(executor, logger,
+                                                   docker_image_name, expected_version)))
+                    if not in_flight:
+                        break
+
+                    current_version, docker_image_name, future = in_flight.popleft()
+                    # Populate the cache in enumeration order, so that
+                    # `all_loaded` stays deterministic
+                    bundle_version = cls._load_cache.setdefault(docker_image_name,
+                                                                future.result())
+                    if bundle_version is None:
+                        failures = failures - 1
+                        bailing_out_maybe = ", bailing out" if failures < 0 else ""
+                        logger.info(f"Could not load version {current_version}{bailing_out_maybe}")
+                    else:
+                        successes = successes + 1
+                        yield bundle_version
+            finally:
+                for _, _, future in in_flight:
+                    future.cancel()
 
         if not successes:
             msg = f"No single image could be found! pattern={pattern}, from={first_version}"
@@ -377,26 +497,33 @@ class BundleVersion:
             raise ValueError(msg)
 
 
-def split_yaml_documents (yaml_fd_or_string):
+def _package_version (parsed_yaml):
+    """Returns the version in the `olm.package` property of `parsed_yaml`, or None."""
+    for prop in parsed_yaml.get("properties", []):
+        if prop["type"] == "olm.package":
+            return prop["value"]["version"]
+    return None
+
+
+def _extract_schema (yaml_doc):
+    """Returns the value of the top-level `schema:` key of `yaml_doc`, or None."""
+    matched = _SCHEMA_RE.search(yaml_doc)
+    return matched[1] if matched else None
+
+
+def split_yaml_documents (yaml_fd):
     """Split a YAML file into documents (separated by three dashes). Returns each as a string.
     Yields pairs of (starting line number, YAML text)."""
 
-    if isinstance(yaml_fd_or_string, bytes):
-        yaml_fd = (StringIO(yaml_fd_or_string.decode("utf-8")))
-    elif isinstance(yaml_fd_or_string, str):
-        yaml_fd = (StringIO(yaml_fd_or_string))
-    else:
-        yaml_fd = yaml_fd_or_string
-
     for key, group in itertools.groupby(
             enumerate(yaml_fd, start=1),
             lambda num_and_line: num_and_line[1].startswith('---')):
         if key:
             continue
-        nums_and_lines = list(group)
-        yaml_doc = "".join(num_and_line[1] for num_and_line in nums_and_lines)
-        if re.search("\\S", yaml_doc):
-            yield (nums_and_lines[0][0], yaml_doc)
+        first_lineno, first_line = next(group)
+        yaml_doc = "".join([first_line] + [line for _, line in group])
+        if _NONWS_RE.search(yaml_doc):
+            yield (first_lineno, yaml_doc)
 
 
 if __name__ ==  '__main__':